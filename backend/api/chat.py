@@ -1,16 +1,30 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Set, Tuple, AsyncIterator, Awaitable
+from collections import OrderedDict
+from itertools import islice
 import os
+import math
 import time
-import json
+import orjson
 import hashlib
+import asyncio
+import logging
+
+import anyio
+
+try:
+    import re2 as _re  # type: ignore
+except ImportError:
+    import re as _re
 
 try:
     # Prefer official OpenAI SDK v1 style
-    from openai import OpenAI  # type: ignore
+    import httpx
+    from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError  # type: ignore
 except Exception:  # pragma: no cover
-    OpenAI = None  # will raise at runtime with clear error
+    AsyncOpenAI = None  # will raise at runtime with clear error
 
 
 class ChatRequest(BaseModel):
@@ -27,135 +41,393 @@ class ChatResponse(BaseModel):
 
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
-# Simple in-memory TTL cache for early cost control
-_CACHE: Dict[str, Dict[str, Any]] = {}
+# Bounded in-memory LRU with TTL for early cost control: key -> (expires_at, value)
+_CACHE: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
 _CACHE_TTL_SECONDS = int(os.getenv("GPT_CACHE_TTL_SECONDS", "3600"))
+# Upstream failures (rate limits, 5xx) are remembered briefly per model so a burst of
+# requests doesn't keep hammering an API that is already failing
+_NEG_CACHE_TTL_SECONDS = int(os.getenv("GPT_NEG_CACHE_TTL_SECONDS", "30"))
+_NEG_PREFIX = "neg:"
+_CACHE_MAX = int(os.getenv("GPT_CACHE_MAX", "10000"))
+# Every N writes, sweep the oldest decile for expired entries
+_CACHE_SWEEP_EVERY = 1000
+_cache_writes = 0
 
 # Optional Redis cache (preferred for efficiency)
+# Async client over a shared pool so cache round-trips don't block the event loop
+_REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
 _redis_client = None
+_set_if_better = None
+
+# Atomic compare-and-set: keep the stored answer if its (tier, tokens) ranks higher.
+# KEYS[1] = cache key; ARGV = ttl, payload, tier, tokens
+_SET_IF_BETTER_LUA = """
+local cur = redis.call('GET', KEYS[1])
+if cur then
+    local ok, old = pcall(cjson.decode, cur)
+    if ok and type(old) == 'table' then
+        local old_tier = tonumber(old['tier']) or 1
+        local old_tokens = tonumber(old['tokens']) or 0
+        local tier = tonumber(ARGV[3])
+        local tokens = tonumber(ARGV[4])
+        if old_tier > tier or (old_tier == tier and old_tokens > tokens) then
+            return 0
+        end
+    end
+end
+redis.call('SETEX', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
 try:
-    import redis  # type: ignore
+    import redis.asyncio as aioredis  # type: ignore
 
     redis_url = os.getenv("REDIS_URL")
     if redis_url:
-        _redis_client = redis.StrictRedis.from_url(redis_url, decode_responses=True)
+        # Raw bytes go straight into orjson.loads; no unicode decode step
+        _redis_pool = aioredis.ConnectionPool.from_url(redis_url, max_connections=_REDIS_MAX_CONNECTIONS)
+        # from_pool hands pool ownership to the client, so aclose() disconnects it too
+        _redis_client = aioredis.Redis.from_pool(_redis_pool)
+        _set_if_better = _redis_client.register_script(_SET_IF_BETTER_LUA)
 except Exception:
     _redis_client = None
 
 
+async def close_clients() -> None:
+    """Release pooled connections; called from the app lifespan on shutdown."""
+    global _openai_client
+    # Drain pending background cache writes before the pool goes away
+    if _BG_TASKS:
+        await asyncio.gather(*_BG_TASKS, return_exceptions=True)
+    if _redis_client:
+        await _redis_client.aclose()
+    if _openai_client:
+        await _openai_client.close()
+        # A later lifespan in the same process must build a fresh client
+        _openai_client = None
+
+
+# Shared async client: one HTTP/2 keep-alive pool instead of a new client + TLS per request
+_openai_client = None
+
+
 def _get_openai_client():
-    if OpenAI is None:
+    global _openai_client
+    if _openai_client:
+        return _openai_client
+    if AsyncOpenAI is None:
         raise RuntimeError("OpenAI SDK not available. Please install 'openai' package.")
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY is not set.")
-    return OpenAI(api_key=api_key)
+    _openai_client = AsyncOpenAI(
+        api_key=api_key,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+        ),
+    )
+    return _openai_client
 
 
-def _cache_key(message: str) -> str:
-    h = hashlib.md5(message.encode("utf-8")).hexdigest()
-    return f"chat:{h}"
+_KEY_PREFIX = "c:"
 
 
-def _get_cached(message: str) -> Optional[Dict[str, Any]]:
-    key = _cache_key(message)
-    if _redis_client:
-        cached = _redis_client.get(key)
-        if cached:
-            try:
-                return json.loads(cached)
-            except Exception:
-                return None
+def _cache_key_b(message_bytes: bytes) -> str:
+    # BLAKE2b-128: cheaper than MD5 on short strings, same tag for Redis and in-memory
+    return _KEY_PREFIX + hashlib.blake2b(message_bytes, digest_size=16).hexdigest()
+
+
+def _decode(cached: Optional[bytes]) -> Optional[Dict[str, Any]]:
+    if not cached:
+        return None
+    try:
+        return orjson.loads(cached)
+    except Exception:
         return None
-    # Fallback in-memory cache
+
+
+def _get_local(key: str) -> Optional[Dict[str, Any]]:
     entry = _CACHE.get(key)
     if not entry:
         return None
-    if time.time() - entry["ts"] > _CACHE_TTL_SECONDS:
-        _CACHE.pop(key, None)
+    expires_at, value = entry
+    if time.time() > expires_at:
+        del _CACHE[key]
         return None
-    return entry["value"]
+    _CACHE.move_to_end(key)
+    return value
+
+
+def _sweep_local(now: float) -> None:
+    # LRU order keeps the coldest entries at the front, where expired ones collect
+    expired = [
+        key
+        for key, (expires_at, _) in islice(_CACHE.items(), max(1, _CACHE_MAX // 10))
+        if now > expires_at
+    ]
+    for key in expired:
+        del _CACHE[key]
+
+
+def _set_local(key: str, value: Dict[str, Any], ttl: int = _CACHE_TTL_SECONDS) -> None:
+    global _cache_writes
+    now = time.time()
+    _CACHE[key] = (now + ttl, value)
+    _CACHE.move_to_end(key)
+    while len(_CACHE) > _CACHE_MAX:
+        _CACHE.popitem(last=False)
+    _cache_writes += 1
+    if _cache_writes % _CACHE_SWEEP_EVERY == 0:
+        _sweep_local(now)
+
+
+async def _mget_cached(keys: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """Look up several keys in one Redis round-trip."""
+    if _redis_client:
+        async with _redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(key)
+            raw = await pipe.execute()
+        return [_decode(c) for c in raw]
+    return [_get_local(key) for key in keys]
+
 
+def _model_tier(model: str) -> int:
+    # Full models outrank mini ones; a mini retry must not clobber a full answer
+    return 2 if "gpt-4o" in model and "mini" not in model else 1
 
-def _set_cached(message: str, value: Dict[str, Any]) -> None:
-    key = _cache_key(message)
+
+def _quality(value: Dict[str, Any]) -> Tuple[int, int]:
+    return value.get("tier", 1), value.get("tokens", 0)
+
+
+async def _set_cached(key: str, value: Dict[str, Any]) -> None:
+    value.setdefault("tier", _model_tier(value.get("model", "")))
     if _redis_client:
-        _redis_client.setex(key, _CACHE_TTL_SECONDS, json.dumps(value))
+        # Compare and write in one script so concurrent misses can't race past the check
+        await _set_if_better(keys=[key], args=[_CACHE_TTL_SECONDS, orjson.dumps(value), *_quality(value)])
         return
-    _CACHE[key] = {"ts": time.time(), "value": value}
+    # In-memory check and write run without yielding, so they're already atomic
+    existing = _get_local(key)
+    if existing and _quality(existing) > _quality(value):
+        return
+    _set_local(key, value)
+
+
+async def _set_negative(model: str, status: int, until: float) -> None:
+    neg_key = _NEG_PREFIX + model
+    value = {"status": status, "until": until}
+    if _redis_client:
+        await _redis_client.setex(neg_key, _NEG_CACHE_TTL_SECONDS, orjson.dumps(value))
+        return
+    _set_local(neg_key, value, ttl=_NEG_CACHE_TTL_SECONDS)
+
+
+def _upstream_failure_status(exc: Exception) -> Optional[int]:
+    """Status to cache and return for transient upstream failures, else None."""
+    if AsyncOpenAI is None:
+        return None
+    # A single slow request says nothing about the model's health; don't trip the breaker
+    if isinstance(exc, APITimeoutError):
+        return None
+    if isinstance(exc, RateLimitError):
+        return 429
+    if isinstance(exc, APIStatusError) and exc.status_code >= 500:
+        return 503
+    if isinstance(exc, APIConnectionError):
+        return 503
+    return None
+
+
+# Generic details: the breaker is shared across users, so never echo one caller's upstream error
+_UPSTREAM_DETAIL = {
+    429: "Upstream rate limit reached; please retry shortly.",
+    503: "Upstream model temporarily unavailable; please retry shortly.",
+}
+
+
+def _upstream_error(status: int, until: float) -> HTTPException:
+    retry_after = max(1, math.ceil(until - time.time()))
+    return HTTPException(
+        status_code=status,
+        detail=_UPSTREAM_DETAIL.get(status, _UPSTREAM_DETAIL[503]),
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+# Strong references to in-flight background writes so they aren't GC'd mid-run
+_BG_TASKS: Set[asyncio.Task] = set()
+
+
+async def _run_logged(coro: Awaitable[None]) -> None:
+    try:
+        await coro
+    except Exception:
+        logger.exception("Background cache write failed")
+
+
+def _schedule_background(coro: Awaitable[None]) -> None:
+    # Cache writes aren't needed for correctness; don't make the caller wait on them
+    task = asyncio.create_task(_run_logged(coro))
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+
+
+def _schedule_cache_write(key: str, value: Dict[str, Any]) -> None:
+    _schedule_background(_set_cached(key, value))
 
 
 SYSTEM_PROMPT = (
     "You are Veil, ThreatVeil's AI security analyst. Be concise, actionable, and professional. "
     "Cite concrete signals when possible, include 1-2 next steps, and avoid speculation."
 )
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Compiled once; RE2 (if installed) guarantees linear-time matching on adversarial input.
+# Security questions legitimately contain these strings, so matches are only logged
+# unless CHAT_BLOCK_INJECTION is enabled.
+_INJECTION_RE = _re.compile(r"(?i)(ignore previous|system prompt|</?script|\bDROP TABLE\b|\bexec\()")
+_BLOCK_INJECTION = os.getenv("CHAT_BLOCK_INJECTION", "").lower() in ("1", "true", "yes")
+
+
+def _is_blocked(message: str, key: str) -> bool:
+    if not _INJECTION_RE.search(message):
+        return False
+    logger.info("Injection-like pattern in chat message %s", key)
+    return _BLOCK_INJECTION
+
+# Resolved once at import; env doesn't change at runtime
+_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "500"))
+_MODEL_MINI = os.getenv("OPENAI_MODEL_MINI", "gpt-4o-mini")
+_MODEL_FULL = os.getenv("OPENAI_MODEL_FULL", "gpt-4o")
+
+
+_NEG_KEY_MINI = _NEG_PREFIX + _MODEL_MINI
+_NEG_KEY_FULL = _NEG_PREFIX + _MODEL_FULL
 
 
 def _select_model(message: str) -> str:
-    if len(message) <= 80 and "?" in message:
-        return os.getenv("OPENAI_MODEL_MINI", "gpt-4o-mini")
-    return os.getenv("OPENAI_MODEL_FULL", "gpt-4o")
+    return _MODEL_MINI if len(message) <= 80 and "?" in message else _MODEL_FULL
+
+
+def _cache_payload(content: str, model_used: str, tokens_total: int) -> Dict[str, Any]:
+    # Basic cost estimate (update if pricing changes)
+    # Inputs are unknown granularity here; use total as approximation
+    cost_usd = 0.0
+    try:
+        # Rough pricing based on context guide (per 1M tokens)
+        if "gpt-4o-mini" in model_used:
+            cost_usd = (tokens_total * (0.15 + 0.60) / 2.0) / 1_000_000.0
+        else:
+            cost_usd = (tokens_total * (2.50 + 10.00) / 2.0) / 1_000_000.0
+    except Exception:
+        cost_usd = 0.0
+    return {
+        "content": content,
+        "model": model_used,
+        "tokens": tokens_total,
+        "cost_usd": round(cost_usd, 6),
+    }
+
+
+def _sse(data: str) -> str:
+    # Multi-line payloads need one "data:" field per line
+    return "".join(f"data: {line}\n" for line in data.split("\n")) + "\n"
+
+
+async def _stream_completion(stream, key: str, model: str) -> AsyncIterator[str]:
+    """Relay completion deltas as SSE events, then cache the assembled answer."""
+    buf: List[str] = []
+    model_used = model
+    tokens_total = 0
+    try:
+        async for chunk in stream:
+            model_used = chunk.model or model_used
+            if chunk.usage:
+                tokens_total = chunk.usage.total_tokens
+            if chunk.choices and (delta := chunk.choices[0].delta.content):
+                buf.append(delta)
+                yield _sse(delta)
+    except Exception:
+        # Headers are already sent; tell the client the answer is truncated and don't cache it
+        logger.exception("Chat completion stream failed")
+        yield "event: error\n" + _sse("stream interrupted")
+        return
+    finally:
+        # On client disconnect Starlette cancels this task; shield the close so the pooled
+        # connection is still released and upstream generation stops
+        with anyio.CancelScope(shield=True):
+            await stream.close()
+    yield _sse("[DONE]")
+    _schedule_cache_write(key, _cache_payload("".join(buf), model_used, tokens_total))
 
 
 @router.post("/api/v2/chat/message", response_model=ChatResponse)
 async def chat_message(req: ChatRequest):
-    # Cache first
-    cached = _get_cached(req.message)
+    msg = req.message
+    # Derive the cache key once per request; lookups and writes reuse it
+    key = _cache_key_b(msg.encode("utf-8"))
+
+    # Cache first; both models' negative entries ride along in the same round-trip
+    cached, failed_mini, failed_full = await _mget_cached([key, _NEG_KEY_MINI, _NEG_KEY_FULL])
+    if cached and req.stream:
+        return StreamingResponse(
+            iter((_sse(cached["content"]), _sse("[DONE]"))), media_type="text/event-stream"
+        )
     if cached:
-        return ChatResponse(
-            response=cached["content"],
-            model=cached["model"],
-            tokens_used=cached.get("tokens", 0),
-            cached=True,
+        # Trusted cache data: skip ChatResponse validation and serialize directly
+        return ORJSONResponse(
+            {
+                "response": cached["content"],
+                "model": cached["model"],
+                "tokens_used": cached.get("tokens", 0),
+                "cached": True,
+            }
         )
 
-    # Validate length and basic injection patterns
-    if len(req.message) > 4000:
-        raise HTTPException(status_code=400, detail="Message too long")
+    # Length is enforced by ChatRequest; flag basic injection patterns
+    if _is_blocked(msg, key):
+        raise HTTPException(status_code=400, detail="Message blocked")
+
+    # Model selection only matters on a miss
+    model = _select_model(msg)
+    failed = failed_mini if model == _MODEL_MINI else failed_full
+
+    # Recent upstream failure for this model: short-circuit instead of retrying
+    if failed:
+        raise _upstream_error(failed.get("status", 503), failed.get("until", 0.0))
 
     try:
         client = _get_openai_client()
-        model = _select_model(req.message)
 
-        # Non-streamed minimal call to start
-        response = client.chat.completions.create(
+        if req.stream:
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=[_SYSTEM_MSG, {"role": "user", "content": msg}],
+                temperature=0.4,
+                max_tokens=_MAX_TOKENS,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            return StreamingResponse(_stream_completion(stream, key, model), media_type="text/event-stream")
+
+        # Buffered call
+        response = await client.chat.completions.create(
             model=model,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": req.message},
-            ],
+            messages=[_SYSTEM_MSG, {"role": "user", "content": msg}],
             temperature=0.4,
-            max_tokens=int(os.getenv("OPENAI_MAX_TOKENS", "500")),
+            max_tokens=_MAX_TOKENS,
         )
 
         content = response.choices[0].message.content or ""
         tokens_total = getattr(response.usage, "total_tokens", 0)
-
-        # Basic cost estimate (update if pricing changes)
-        # Inputs are unknown granularity here; use total as approximation
         model_used = response.model or model
-        cost_usd = 0.0
-        try:
-            # Rough pricing based on context guide (per 1M tokens)
-            if "gpt-4o-mini" in model_used:
-                cost_usd = (tokens_total * (0.15 + 0.60) / 2.0) / 1_000_000.0
-            else:
-                cost_usd = (tokens_total * (2.50 + 10.00) / 2.0) / 1_000_000.0
-        except Exception:
-            cost_usd = 0.0
 
         # Cache result
-        _set_cached(
-            req.message,
-            {
-                "content": content,
-                "model": model_used,
-                "tokens": tokens_total,
-                "cost_usd": round(cost_usd, 6),
-            },
-        )
+        _schedule_cache_write(key, _cache_payload(content, model_used, tokens_total))
 
         return ChatResponse(
             response=content,
@@ -166,6 +438,12 @@ async def chat_message(req: ChatRequest):
     except HTTPException:
         raise
     except Exception as e:
+        status = _upstream_failure_status(e)
+        if status:
+            logger.warning("Upstream failure for %s (%s): %s", model, status, e)
+            until = time.time() + _NEG_CACHE_TTL_SECONDS
+            _schedule_background(_set_negative(model, status, until))
+            raise _upstream_error(status, until)
         raise HTTPException(status_code=500, detail=str(e))
 
 
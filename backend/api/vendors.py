@@ -1,7 +1,16 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Optional
 import time
+import hashlib
+import numpy as np
+import orjson
+
+try:
+    # Optional JIT for large signal sets; falls back to the vectorized NumPy kernel
+    from numba import njit  # type: ignore
+except Exception:  # pragma: no cover
+    njit = None
 
 router = APIRouter()
 
@@ -25,6 +34,15 @@ class Vendor(BaseModel):
 
 # In-memory demo dataset
 _VENDORS: Dict[str, Vendor] = {}
+# Serialized vendor list as (etag, body); rebuilt whenever _VENDORS changes
+_VENDORS_CACHE: Optional[Tuple[str, bytes]] = None
+
+
+def _refresh_vendors_cache() -> None:
+    global _VENDORS_CACHE
+    body = orjson.dumps([v.model_dump() for v in _VENDORS.values()])
+    etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+    _VENDORS_CACHE = (etag, body)
 
 
 def _seed_demo_data():
@@ -65,42 +83,88 @@ def _seed_demo_data():
     for v in demo:
         v.risk_score, v.reasons = _heuristic_risk(v.signals)
         _VENDORS[v.id] = v
+    _refresh_vendors_cache()
+
+
+# Per-type weights; unlisted types weigh 1.0
+_TYPE_WEIGHT: Dict[str, float] = {"github": 1.5, "breach": 1.5, "cve": 1.2, "cert": 1.2}
+_SEVEN_DAYS = 7 * 24 * 3600
+
+
+def _signal_columns(signals: List[Signal]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Struct-of-arrays view of signals: severity, type weight, detected_at."""
+    n = len(signals)
+    sev = np.fromiter((s.severity_score for s in signals), dtype=np.int32, count=n)
+    weight = np.fromiter((_TYPE_WEIGHT.get(s.signal_type, 1.0) for s in signals), dtype=np.float64, count=n)
+    ts = np.fromiter((s.detected_at for s in signals), dtype=np.float64, count=n)
+    return sev, weight, ts
+
+
+def _score_numpy(sev: np.ndarray, weight: np.ndarray, ts: np.ndarray, now: float) -> Tuple[int, np.ndarray]:
+    # Recent signals weigh more (last 7 days)
+    recency = np.where(now - ts < _SEVEN_DAYS, 1.2, 1.0)
+    contrib = np.minimum(100, sev * weight * recency).astype(np.int32)
+    return int(np.clip((contrib // 4).sum(), 0, 100)), contrib  # normalize per-signal
+
+
+def _score_loop(sev, weight, ts, now):
+    # Same math as _score_numpy as a plain loop for Numba; tests keep the two in step
+    n = sev.shape[0]
+    contrib = np.empty(n, dtype=np.int32)
+    total = 0
+    for i in range(n):
+        recency = 1.2 if now - ts[i] < _SEVEN_DAYS else 1.0
+        c = sev[i] * weight[i] * recency
+        if c > 100.0:
+            c = 100.0
+        contrib[i] = np.int32(c)
+        total += contrib[i] // 4
+    return min(max(total, 0), 100), contrib
+
+
+if njit is not None:
+    # No fastmath: the int32 truncation is sensitive to rounding/reassociation
+    _score_kernel = njit(cache=True, boundscheck=False)(_score_loop)
+    # Compile at import so the first request doesn't pay for it
+    _score_kernel(np.zeros(1, dtype=np.int32), np.ones(1), np.zeros(1), 0.0)
+else:
+    _score_kernel = _score_numpy
 
 
 def _heuristic_risk(signals: List[Signal]) -> (int, List[str]):
-    score = 0
-    reasons: List[str] = []
-    for s in signals:
-        # Weight types
-        weight = 1.0
-        if s.signal_type in ("github", "breach"):
-            weight = 1.5
-        elif s.signal_type in ("cve", "cert"):
-            weight = 1.2
-        # Recent signals weigh more (last 7 days)
-        recency_boost = 1.2 if (time.time() - s.detected_at) < 7 * 24 * 3600 else 1.0
-        contribution = int(min(100, s.severity_score * weight * recency_boost))
-        score += contribution // 4  # normalize per-signal
-        reasons.append(f"[{s.signal_type}] {s.metadata.get('detail', '')} (sev {s.severity_score})")
-
-    score = max(0, min(100, score))
-    # Keep top 3 reasons by implied severity
-    reasons = reasons[:3]
+    if not signals:
+        return 0, []
+    sev, weight, ts = _signal_columns(signals)
+    score, contrib = _score_kernel(sev, weight, ts, time.time())
+    score = int(score)
+
+    # Keep top 3 reasons by contribution
+    top = np.arange(len(signals))
+    if len(top) > 3:
+        top = np.argpartition(-contrib, 2)[:3]
+    top = top[np.argsort(-contrib[top], kind="stable")]
+    reasons = [
+        f"[{signals[i].signal_type}] {signals[i].metadata.get('detail', '')} (sev {signals[i].severity_score})"
+        for i in top
+    ]
     return score, reasons
 
 
 @router.get("/api/v1/vendors", response_model=List[Vendor])
-async def list_vendors():
-    _seed_demo_data()
-    return list(_VENDORS.values())
+async def list_vendors(request: Request):
+    etag, body = _VENDORS_CACHE
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 
 @router.get("/api/v1/vendors/{vendor_id}", response_model=Vendor)
 async def get_vendor(vendor_id: str):
-    _seed_demo_data()
     v = _VENDORS.get(vendor_id)
     if not v:
         raise HTTPException(status_code=404, detail="Vendor not found")
     return v
 
 
+# Seed at import so handlers work whether or not the app lifespan runs
+_seed_demo_data()
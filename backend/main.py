@@ -1,12 +1,25 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from api.chat import router as chat_router
+from fastapi.responses import ORJSONResponse
+from api.chat import router as chat_router, close_clients
 from api.vendors import router as vendors_router
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_clients()
+
+
 def create_app() -> FastAPI:
-    application = FastAPI(title="ThreatVeil API", version="0.1.0")
+    application = FastAPI(
+        title="ThreatVeil API",
+        version="0.1.0",
+        lifespan=lifespan,
+        default_response_class=ORJSONResponse,
+    )
     application.add_middleware(
         CORSMiddleware,
         allow_origins=[os.getenv("CORS_ORIGINS", "http://localhost:3000")],
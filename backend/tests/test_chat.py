@@ -0,0 +1,196 @@
+import asyncio
+from types import SimpleNamespace
+
+import anyio
+import pytest
+from fastapi.testclient import TestClient
+
+from api import chat
+from main import app
+
+SECURITY_QUESTIONS = [
+    "How do I detect `ignore previous instructions` injection?",
+    "What is system prompt leakage?",
+    "Is `'; DROP TABLE users` in this log an SQLi attempt?",
+    "Why is <script> in a vendor's form field dangerous?",
+    "Does calling exec( on user input count as RCE?",
+]
+
+
+class _FakeStream:
+    def __init__(self, deltas, fail=False, hang=False):
+        self.deltas = deltas
+        self.fail = fail
+        self.hang = hang
+        self.closed = False
+
+    async def __aiter__(self):
+        for d in self.deltas:
+            yield SimpleNamespace(
+                model="gpt-4o-mini",
+                usage=None,
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=d))],
+            )
+        if self.fail:
+            raise RuntimeError("upstream reset")
+        if self.hang:
+            await anyio.sleep_forever()
+
+    async def close(self):
+        await anyio.sleep(0)  # checkpoint: raises if the caller's scope is cancelled
+        self.closed = True
+
+
+class _FakeCompletions:
+    def __init__(self):
+        self.calls = []
+        self.stream = None
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("stream"):
+            return self.stream
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Veil answer"))],
+            usage=SimpleNamespace(total_tokens=12),
+            model=kwargs["model"],
+        )
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    fake = _FakeCompletions()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=fake))
+    monkeypatch.setattr(chat, "_get_openai_client", lambda: client)
+    monkeypatch.setattr(chat, "_redis_client", None)
+    chat._CACHE.clear()
+    return fake
+
+
+@pytest.mark.parametrize("message", SECURITY_QUESTIONS)
+def test_security_questions_reach_the_model(completions, message):
+    with TestClient(app) as client:
+        res = client.post("/api/v2/chat/message", json={"message": message})
+    assert res.status_code == 200
+    assert res.json()["response"] == "Veil answer"
+    assert completions.calls[0]["messages"][-1]["content"] == message
+
+
+def test_block_toggle_rejects_matches(completions, monkeypatch):
+    monkeypatch.setattr(chat, "_BLOCK_INJECTION", True)
+    with TestClient(app) as client:
+        blocked = client.post("/api/v2/chat/message", json={"message": SECURITY_QUESTIONS[0]})
+        allowed = client.post("/api/v2/chat/message", json={"message": "Which vendors changed risk this week?"})
+    assert blocked.status_code == 400
+    assert allowed.status_code == 200
+    assert len(completions.calls) == 1
+
+
+def test_stream_relays_deltas_and_closes_upstream(completions):
+    completions.stream = _FakeStream(["Rotate ", "the key."])
+    with TestClient(app) as client:
+        res = client.post("/api/v2/chat/message", json={"message": "What now?", "stream": True})
+    assert res.text == "data: Rotate \n\ndata: the key.\n\ndata: [DONE]\n\n"
+    assert completions.stream.closed
+
+
+def test_stream_failure_emits_error_event(completions):
+    completions.stream = _FakeStream(["Partial"], fail=True)
+    with TestClient(app) as client:
+        res = client.post("/api/v2/chat/message", json={"message": "What now?", "stream": True})
+    assert "event: error\n" in res.text
+    assert "[DONE]" not in res.text
+    assert completions.stream.closed
+    assert not chat._CACHE
+
+
+def test_rate_limit_short_circuits_other_prompts_on_same_model(completions, monkeypatch):
+    import httpx
+    from openai import RateLimitError
+
+    async def rate_limited(**kwargs):
+        completions.calls.append(kwargs)
+        response = httpx.Response(429, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+        raise RateLimitError("rate limited", response=response, body=None)
+
+    monkeypatch.setattr(completions, "create", rate_limited)
+    with TestClient(app) as client:
+        first = client.post("/api/v2/chat/message", json={"message": "Summarize Acme's exposure."})
+        second = client.post("/api/v2/chat/message", json={"message": "Summarize Globex's exposure."})
+    assert first.status_code == 429
+    assert second.status_code == 429
+    assert "rate limited" not in second.json()["detail"]
+    assert 1 <= int(second.headers["retry-after"]) <= chat._NEG_CACHE_TTL_SECONDS
+    assert len(completions.calls) == 1
+
+
+def test_timeout_does_not_trip_breaker(completions, monkeypatch):
+    import httpx
+    from openai import APITimeoutError
+
+    async def timed_out(**kwargs):
+        completions.calls.append(kwargs)
+        raise APITimeoutError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+    monkeypatch.setattr(completions, "create", timed_out)
+    with TestClient(app) as client:
+        first = client.post("/api/v2/chat/message", json={"message": "Summarize Acme's exposure."})
+        second = client.post("/api/v2/chat/message", json={"message": "Summarize Globex's exposure."})
+    assert first.status_code == 500
+    assert second.status_code == 500
+    assert len(completions.calls) == 2
+
+
+def test_cache_write_keeps_higher_quality_answer(monkeypatch):
+    monkeypatch.setattr(chat, "_redis_client", None)
+    chat._CACHE.clear()
+    full = chat._cache_payload("full answer", "gpt-4o", 300)
+    asyncio.run(chat._set_cached("c:k", full))
+    asyncio.run(chat._set_cached("c:k", chat._cache_payload("mini answer", "gpt-4o-mini", 900)))
+    asyncio.run(chat._set_cached("c:k", chat._cache_payload("shorter", "gpt-4o", 100)))
+    assert chat._get_local("c:k")["content"] == "full answer"
+    asyncio.run(chat._set_cached("c:k", chat._cache_payload("longer", "gpt-4o", 400)))
+    assert chat._get_local("c:k")["content"] == "longer"
+
+
+def test_close_clients_resets_openai_client(monkeypatch):
+    closed = []
+
+    async def close():
+        closed.append(True)
+
+    monkeypatch.setattr(chat, "_redis_client", None)
+    monkeypatch.setattr(chat, "_openai_client", SimpleNamespace(close=close))
+    asyncio.run(chat.close_clients())
+    assert closed == [True]
+    assert chat._openai_client is None
+
+
+def test_stream_closes_upstream_when_consumer_is_cancelled():
+    # Mirrors a client disconnect: Starlette cancels the task group driving the generator
+    stream = _FakeStream(["Partial"], hang=True)
+
+    async def main():
+        async def consume():
+            async for _ in chat._stream_completion(stream, "c:k", "gpt-4o-mini"):
+                pass
+
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(consume)
+            await anyio.sleep(0.05)
+            tg.cancel_scope.cancel()
+
+    anyio.run(main)
+    assert stream.closed
+
+
+def test_stream_closes_upstream_on_aclose():
+    stream = _FakeStream(["Partial", "more"])
+
+    async def main():
+        gen = chat._stream_completion(stream, "c:k", "gpt-4o-mini")
+        assert await gen.__anext__() == "data: Partial\n\n"
+        await gen.aclose()
+
+    anyio.run(main)
+    assert stream.closed
@@ -0,0 +1,76 @@
+import time
+
+from api.vendors import (
+    Signal,
+    _VENDORS,
+    _heuristic_risk,
+    _score_kernel,
+    _score_loop,
+    _score_numpy,
+    _signal_columns,
+)
+
+
+def _reference_score(signals):
+    # Scoring loop as it was before the NumPy/Numba kernel
+    score = 0
+    for s in signals:
+        weight = 1.0
+        if s.signal_type in ("github", "breach"):
+            weight = 1.5
+        elif s.signal_type in ("cve", "cert"):
+            weight = 1.2
+        recency_boost = 1.2 if (time.time() - s.detected_at) < 7 * 24 * 3600 else 1.0
+        contribution = int(min(100, s.severity_score * weight * recency_boost))
+        score += contribution // 4
+    return max(0, min(100, score))
+
+
+def test_kernel_matches_reference_on_demo_signals():
+    assert _VENDORS
+    for v in _VENDORS.values():
+        assert _heuristic_risk(v.signals)[0] == _reference_score(v.signals)
+
+
+def test_kernel_matches_reference_on_mixed_signals():
+    now = time.time()
+    signals = [
+        Signal(signal_type=t, severity_score=sev, detected_at=now - age)
+        for t in ("github", "breach", "cve", "cert", "dns")
+        for sev in (0, 1, 33, 67, 84, 100)
+        for age in (60, 30 * 24 * 3600)
+    ]
+    for i in range(len(signals)):
+        chunk = signals[i : i + 4]
+        assert _heuristic_risk(chunk)[0] == _reference_score(chunk)
+    assert _heuristic_risk(signals)[0] == _reference_score(signals) == 100
+
+
+def test_reasons_are_top_three_by_contribution():
+    now = time.time()
+    signals = [
+        Signal(signal_type="dns", severity_score=10, metadata={"detail": "low"}, detected_at=now),
+        Signal(signal_type="github", severity_score=80, metadata={"detail": "high"}, detected_at=now),
+        Signal(signal_type="cve", severity_score=50, metadata={"detail": "mid"}, detected_at=now),
+        Signal(signal_type="dns", severity_score=20, metadata={"detail": "lower"}, detected_at=now),
+    ]
+    _, reasons = _heuristic_risk(signals)
+    assert [r.split("] ")[1].split(" (")[0] for r in reasons] == ["high", "mid", "lower"]
+
+
+def test_numpy_fallback_matches_kernel():
+    now = time.time()
+    signals = [
+        Signal(signal_type=t, severity_score=sev, detected_at=now - age)
+        for t in ("github", "breach", "cve", "cert", "dns")
+        for sev in (0, 1, 33, 67, 84, 100)
+        for age in (60, 30 * 24 * 3600)
+    ]
+    for i in range(len(signals)):
+        chunk = signals[i : i + 4]
+        cols = _signal_columns(chunk)
+        np_score, np_contrib = _score_numpy(*cols, now)
+        for kernel in (_score_kernel, _score_loop):
+            score, contrib = kernel(*cols, now)
+            assert int(score) == np_score == _reference_score(chunk)
+            assert contrib.tolist() == np_contrib.tolist()
@@ -0,0 +1,19 @@
+from fastapi.testclient import TestClient
+
+from main import app
+
+
+def test_vendor_endpoints_work_without_lifespan():
+    # No `with`: the lifespan never runs, as when the router is mounted elsewhere
+    client = TestClient(app)
+    res = client.get("/api/v1/vendors")
+    assert res.status_code == 200
+    assert {v["id"] for v in res.json()} == {"v1", "v2", "v3"}
+    assert client.get("/api/v1/vendors/v1").json()["name"] == "Acme Corp"
+
+
+def test_vendor_list_etag_returns_304():
+    client = TestClient(app)
+    etag = client.get("/api/v1/vendors").headers["etag"]
+    res = client.get("/api/v1/vendors", headers={"If-None-Match": etag})
+    assert res.status_code == 304